@@ -0,0 +1,98 @@
+from typing import Callable, Dict, List, Optional, Tuple
+from mautrix.client import Client
+from mautrix.types import Event, EventType, PaginationDirection
+from mautrix.util.async_db import Database
+from maubot_life_tracking import db
+from datetime import datetime, timezone
+import asyncio
+import logging
+
+
+EVENT_FILTER = {"types": [str(EventType.ROOM_MESSAGE), str(EventType.REACTION), str(EventType.ROOM_ENCRYPTED)]}
+
+
+def parse_response(evt: Event) -> Optional[Tuple[str, str]]:
+    # Mirrors LifeTrackingBot.handle_msg and handle_reaction; returns (outreach_event_id, message)
+    relates_to = getattr(evt.content, "relates_to", None)
+    if not relates_to:
+        return None
+    if evt.type == EventType.ROOM_MESSAGE:
+        if relates_to.in_reply_to and relates_to.in_reply_to.event_id:
+            return relates_to.in_reply_to.event_id, evt.content.body
+    elif evt.type == EventType.REACTION:
+        if relates_to.event_id:
+            return relates_to.event_id, relates_to.key
+    return None
+
+
+async def backfill_room(client: Client, database: Database, room_id: str, outreaches: List[db.Outreach], until: datetime, is_allowed: Callable[[str], bool], batch_size: int, max_pages: int, log: logging.Logger) -> int:
+    outreaches_by_id = {o.event_id: o for o in outreaches}
+    recorded = await db.fetch_response_times(database, room_id, list(outreaches_by_id))
+    # Anything older than the newest recorded response (or the oldest outreach, if none) was seen while the bot was running
+    cutoff = min(o.timestamp for o in outreaches)
+    if recorded:
+        cutoff = max(cutoff, max(recorded.values()))
+
+    responses = []
+    token = None
+    skipped_encrypted = 0
+    for _ in range(max_pages):
+        page = await client.get_messages(room_id, PaginationDirection.BACKWARD, from_token=token, limit=batch_size, filter_json=EVENT_FILTER)
+        reached_cutoff = False
+        for evt in page.events:
+            ts = datetime.fromtimestamp(evt.timestamp / 1000, timezone.utc)
+            if ts < cutoff:
+                reached_cutoff = True
+                break
+            # Events after startup are handled by the live event handlers
+            if ts >= until or evt.event_id in recorded or not is_allowed(evt.sender):
+                continue
+            if evt.type == EventType.ROOM_ENCRYPTED:
+                crypto = getattr(client, "crypto", None)
+                if crypto is None:
+                    skipped_encrypted += 1
+                    continue
+                try:
+                    evt = await crypto.decrypt_megolm_event(evt)
+                except Exception as e:
+                    log.warning(f"backfill could not decrypt {evt.event_id} in room {room_id}: {e}")
+                    continue
+            parsed = parse_response(evt)
+            if parsed is None:
+                continue
+            outreach_event_id, message = parsed
+            if outreach_event_id in outreaches_by_id:
+                responses.append(db.Response(room_id, evt.event_id, outreach_event_id, ts, message))
+        if reached_cutoff or not page.events or not page.end:
+            break
+        token = page.end
+    else:
+        log.warning(f"backfill for room {room_id} stopped after {max_pages} pages without reaching {cutoff.isoformat()}; older responses were not recovered")
+
+    if skipped_encrypted:
+        log.warning(f"backfill skipped {skipped_encrypted} encrypted events in room {room_id} because encryption is not enabled for this client")
+    responses.sort(key=lambda r: r.timestamp)
+    if responses:
+        await db.insert_responses(database, responses)
+    return len(responses)
+
+
+async def backfill_responses(client: Client, database: Database, is_allowed: Callable[[str], bool], since: datetime, until: datetime, batch_size: int = 100, max_pages: int = 10, concurrency: int = 5, log: Optional[logging.Logger] = None) -> int:
+    if log is None:
+        log = logging.getLogger(__name__)
+    outreaches_by_room: Dict[str, List[db.Outreach]] = {}
+    for outreach in await db.fetch_recent_outreaches(database, since):
+        outreaches_by_room.setdefault(outreach.room_id, []).append(outreach)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(room_id: str, outreaches: List[db.Outreach]) -> int:
+        async with semaphore:
+            try:
+                return await backfill_room(client, database, room_id, outreaches, until, is_allowed, batch_size, max_pages, log)
+            except Exception as e:
+                log.warning(f"backfill failed for room {room_id}: {e}")
+                return 0
+
+    counts = await asyncio.gather(*(run(room_id, outreaches) for room_id, outreaches in outreaches_by_room.items()))
+    return sum(counts)
@@ -1,13 +1,14 @@
-from typing import Type, Optional
+from typing import Type, Optional, Dict, Tuple, List
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 from maubot import Plugin, MessageEvent
 from maubot.handlers import event, command
 from mautrix.types import EventType, MessageEvent
 from maubot_life_tracking import db
+from maubot_life_tracking.backfill import backfill_responses
 from mautrix.util.async_db import UpgradeTable
 from zoneinfo import ZoneInfo
 from datetime import datetime, timezone, timedelta
-from maubot_life_tracking.parsers import parse_datetime, parse_interval, render_template, render_csv
+from maubot_life_tracking.parsers import parse_datetime, parse_interval, compile_template, CompiledTemplate, render_csv, render_history, chunk_lines
 import asyncio
 import random
 
@@ -17,12 +18,19 @@ class Config(BaseProxyConfig):
         helper.copy("allowlist")
         helper.copy("default_tz")
         helper.copy("exec_frequency")
+        helper.copy("history_page_size")
+        helper.copy("backfill_lookback")
+        helper.copy("backfill_batch_size")
+        helper.copy("backfill_max_pages")
+        helper.copy("backfill_concurrency")
 
 
 class LifeTrackingBot(Plugin):
     async def start(self) -> None:
         self.config.load_and_update()
         self.running = True
+        # Compiled message templates keyed by (room_id, prompt_name); groups use a room_id of None
+        self.templates: Dict[Tuple[Optional[str], str], CompiledTemplate] = {}
         self.run_loop_task = self.run_loop()
         asyncio.create_task(self.run_loop_task)
     
@@ -30,7 +38,27 @@ class LifeTrackingBot(Plugin):
         self.running = False
         self.run_loop_task = None
 
+    async def backfill(self) -> None:
+        now = datetime.now(timezone.utc)
+        try:
+            count = await backfill_responses(
+                self.client,
+                self.database,
+                self.is_allowed,
+                since=now - parse_interval(self.config["backfill_lookback"]),
+                until=now,
+                batch_size=self.config["backfill_batch_size"],
+                max_pages=self.config["backfill_max_pages"],
+                concurrency=self.config["backfill_concurrency"],
+                log=self.log,
+            )
+            self.log.info(f"Backfilled {count} responses received while offline")
+        except Exception as e:
+            self.log.warn(f"backfill failed: {e}")
+
     async def run_loop(self) -> None:
+        # Responses missed while offline must be recorded before new outreaches go out, or they won't count toward streaks
+        await self.backfill()
         while self.running:
             now = datetime.now(timezone.utc)
             prompts = await db.fetch_prompts(self.database, due=now)
@@ -40,20 +68,67 @@ class LifeTrackingBot(Plugin):
                 room = await self.get_room(prompt.room_id)
                 tz = self.get_tz(room)
                 localnow = now.astimezone(tz)
-                message = render_template(prompt.message_template, localnow)
+                template = self.get_template(prompt.room_id, prompt.name, prompt.message_template)
+                stats = None
+                if template.uses_stats:
+                    stats = await db.fetch_prompt_stats(self.database, prompt.room_id, prompt.name)
+                message = template.render(localnow, stats)
                 evt_id = await self.client.send_text(room.room_id, message)
                 outreach = db.Outreach(room.room_id, evt_id, prompt.name, now, message)
                 await db.insert_outreach(self.database, outreach)
-                if prompt.run_interval is None:
-                    prompt.next_run = None
-                else:
-                    delay = 0
-                    if prompt.max_random_delay is not None:
-                        delay = random.randint(0, int(prompt.max_random_delay.total_seconds()))
-                    prompt.next_run += prompt.run_interval + timedelta(seconds=delay)
+                self.advance_schedule(prompt)
                 await db.upsert_prompt(self.database, prompt)
 
+            groups = await db.fetch_groups(self.database, due=now)
+            self.log.info(f"Found {len(groups)} groups ready for outreach")
+            for group in groups:
+                await self.send_group(group)
+
             await asyncio.sleep(parse_interval(self.config["exec_frequency"]).total_seconds())
+
+    async def send_group(self, group: db.Group) -> None:
+        now = datetime.now(timezone.utc)
+        rooms = await db.fetch_group_rooms(self.database, group.name)
+        template = self.get_template(None, group.name, group.message_template)
+        stats_by_room = {}
+        if template.uses_stats:
+            stats_by_room = await db.fetch_group_prompt_stats(self.database, group.name)
+        # Unless the template uses per-room stats, it only depends on the local time, so render it once per timezone
+        messages = {}
+        for room in rooms:
+            tz = self.get_tz(room)
+            if template.uses_stats:
+                message = template.render(now.astimezone(tz), stats_by_room.get(room.room_id))
+            else:
+                if tz.key not in messages:
+                    messages[tz.key] = template.render(now.astimezone(tz))
+                message = messages[tz.key]
+            try:
+                evt_id = await self.client.send_text(room.room_id, message)
+            except Exception as e:
+                self.log.warn(f"failed to send group {group.name} to room {room.room_id}: {e}")
+                continue
+            # Record each outreach as soon as it's sent so replies arriving during a long fanout can be correlated
+            await db.insert_outreach(self.database, db.Outreach(room.room_id, evt_id, group.name, now, message))
+        self.advance_schedule(group)
+        await db.upsert_group(self.database, group)
+
+    def get_template(self, room_id: Optional[str], name: str, message_template: str) -> CompiledTemplate:
+        key = (room_id, name)
+        template = self.templates.get(key)
+        if template is None or template.source != message_template:
+            template = compile_template(message_template)
+            self.templates[key] = template
+        return template
+
+    def advance_schedule(self, item: db.Prompt | db.Group) -> None:
+        if item.run_interval is None:
+            item.next_run = None
+        else:
+            delay = 0
+            if item.max_random_delay is not None:
+                delay = random.randint(0, int(item.max_random_delay.total_seconds()))
+            item.next_run += item.run_interval + timedelta(seconds=delay)
     
     def is_allowed(self, sender: str) -> bool:
         if self.config["allowlist"] == False:
@@ -80,6 +155,23 @@ class LifeTrackingBot(Plugin):
             return room.tz
         return ZoneInfo(self.config["default_tz"])
 
+    def describe_schedule(self, item: db.Prompt | db.Group, now: datetime) -> List[str]:
+        items = [f"  - {item.name}:"]
+        if item.next_run:
+            items.append(f"    - Next run: {item.next_run.isoformat()} ({item.next_run - now} from now)")
+        else:
+            items.append(f"    - Not scheduled")
+        if item.run_interval is not None:
+            items.append(f"    - Run interval: {item.run_interval}")
+        else:
+            items.append(f"    - No run interval defined")
+        if item.max_random_delay is not None:
+            items.append(f"    - Max random delay: {item.max_random_delay}")
+        else:
+            items.append(f"    - No random delay")
+        items.append(f"    - Message template: {item.message_template}")
+        return items
+
     @lt_command.subcommand(help="Display configuration for current room.")
     async def info(self, evt: MessageEvent) -> None:
         if not self.is_allowed(evt.sender):
@@ -93,28 +185,21 @@ class LifeTrackingBot(Plugin):
         else:
             items.append(f"- Time zone (bot default): {tz.key}")
         
+        now = datetime.now(timezone.utc)
         prompts = await db.fetch_prompts(self.database, room.room_id)
         if prompts:
             items.append("- Prompts:")
-            now = datetime.now(timezone.utc)
             for prompt in prompts:
-                items.append(f"  - {prompt.name}:")
-                if prompt.next_run:
-                    items.append(f"    - Next run: {prompt.next_run.isoformat()} ({prompt.next_run - now} from now)")
-                else:
-                    items.append(f"    - Not scheduled")
-                if prompt.run_interval is not None:
-                    items.append(f"    - Run interval: {prompt.run_interval}")
-                else:
-                    items.append(f"    - No run interval defined")
-                if prompt.max_random_delay is not None:
-                    items.append(f"    - Max random delay: {prompt.max_random_delay}")
-                else:
-                    items.append(f"    - No random delay")
-                items.append(f"    - Message template: {prompt.message_template}")
+                items.extend(self.describe_schedule(prompt, now))
         else:
             items.append("- No prompts created")
 
+        groups = await db.fetch_groups(self.database, room.room_id)
+        if groups:
+            items.append("- Groups:")
+            for group in groups:
+                items.extend(self.describe_schedule(group, now))
+
         msg = "\n".join(items)
         await evt.mark_read()
         await evt.reply(msg)
@@ -147,12 +232,18 @@ class LifeTrackingBot(Plugin):
             self.log.warn(f"stranger danger: sender={evt.sender}")
             return
         room = await self.get_room(evt.room_id)
+        # Group outreaches are recorded under the group name, so a prompt with the same name would mix their data
+        if any(group.name == prompt_name for group in await db.fetch_groups(self.database, room.room_id)):
+            await evt.mark_read()
+            await evt.reply("This room is in a group with that name; choose a different prompt name.")
+            return
         prompt = await db.fetch_prompt(self.database, room.room_id, prompt_name)
         if prompt is None:
             prompt = db.Prompt(room.room_id, prompt_name, message_template)
         else:
             prompt.message_template = message_template
         await db.upsert_prompt(self.database, prompt)
+        self.templates.pop((room.room_id, prompt_name), None)
         await evt.mark_read()
         await evt.react("✅")
     
@@ -163,6 +254,7 @@ class LifeTrackingBot(Plugin):
             self.log.warn(f"stranger danger: sender={evt.sender}")
             return
         await db.delete_prompt(self.database, evt.room_id, prompt_name)
+        self.templates.pop((evt.room_id, prompt_name), None)
         await evt.mark_read()
         await evt.react("✅")
     
@@ -180,65 +272,183 @@ class LifeTrackingBot(Plugin):
         csvmd = f"```csv\n{csvtext}\n```"
         await evt.reply(csvmd)
     
-    @lt_command.subcommand(help="Set the next run date and time, run interval, and random delay for a prompt.")
+    @lt_command.subcommand(help="Show the most recent outreaches and responses for a prompt. Pass the continuation token to see older ones.")
     @command.argument("prompt_name")
-    @command.argument("date", required=False)
-    @command.argument("time", required=False)
-    @command.argument("run_interval", required=False)
-    @command.argument("max_random_delay", required=False)
-    async def schedule(self, evt: MessageEvent, prompt_name: str, date: Optional[str], time: Optional[str], run_interval: Optional[str], max_random_delay: Optional[str]) -> None:
+    @command.argument("before", required=False)
+    async def history(self, evt: MessageEvent, prompt_name: str, before: Optional[str]) -> None:
         if not self.is_allowed(evt.sender):
             self.log.warn(f"stranger danger: sender={evt.sender}")
             return
         room = await self.get_room(evt.room_id)
-        prompt = await db.fetch_prompt(self.database, room.room_id, prompt_name)
-        if prompt is None:
-            await evt.mark_read()
-            await evt.reply("You must create the prompt with the !prompt command first.")
+        before_outreach = None
+        if before:
+            before_outreach = await db.fetch_outreach(self.database, room.room_id, before)
+            if before_outreach is None or before_outreach.prompt_name != prompt_name:
+                await evt.mark_read()
+                await evt.reply("Invalid continuation token.")
+                return
+
+        page_size = self.config["history_page_size"]
+        # Fetch one extra row to find out whether there is another page
+        ors = await db.fetch_history(self.database, room.room_id, prompt_name, page_size + 1, before_outreach)
+        more = len(ors) > page_size
+        ors = ors[:page_size]
+        await evt.mark_read()
+        if not ors:
+            await evt.reply("No outreaches found.")
             return
 
+        lines = render_history(ors, self.get_tz(room))
+        if more:
+            lines.append(f"Older entries: `!lt history {prompt_name} {ors[-1][0].event_id}`")
+        for chunk in chunk_lines(lines):
+            await evt.reply(chunk)
+    
+    async def apply_schedule(self, evt: MessageEvent, room: db.Room, item: db.Prompt | db.Group, date: Optional[str], time: Optional[str], run_interval: Optional[str], max_random_delay: Optional[str]) -> bool:
         if date and not time:
             await evt.mark_read()
             await evt.reply("You must supply a time if you supply a date.")
-            return
+            return False
 
         if not date:
-            prompt.next_run = None
+            item.next_run = None
         else:
             try:
-                prompt.next_run = parse_datetime(f"{date} {time}", self.get_tz(room))
+                item.next_run = parse_datetime(f"{date} {time}", self.get_tz(room))
             except Exception as e:
                 self.log.warn(e)
                 await evt.mark_read()
                 await evt.reply("Unable to parse date or time. Date should be 'today', 'tomorrow', or 'YYYY-MM-DD'. Time should be 'HH:MM'.")
-                return
+                return False
 
         if not run_interval:
-            prompt.run_interval = None
+            item.run_interval = None
         else:
             try:
-                prompt.run_interval = parse_interval(run_interval)
+                item.run_interval = parse_interval(run_interval)
             except Exception as e:
                 self.log.warn(e)
                 await evt.mark_read()
                 await evt.reply(f"Unable to parse run interval. Expected format is 15d, 15h, or 15m, for 15 days, hours, or minutes, respectively.")
-                return
+                return False
 
         if not max_random_delay:
-            prompt.max_random_delay = None
+            item.max_random_delay = None
         else:
             try:
-                prompt.max_random_delay = parse_interval(max_random_delay)
+                item.max_random_delay = parse_interval(max_random_delay)
             except Exception as e:
                 self.log.warn(e)
                 await evt.mark_read()
                 await evt.reply("Unable to parse max random delay. Expected format is 15d, 15h, or 15m, for 15 days, hours, or minutes, respectively.")
-                return
-        
+                return False
+
+        return True
+
+    @lt_command.subcommand(help="Set the next run date and time, run interval, and random delay for a prompt.")
+    @command.argument("prompt_name")
+    @command.argument("date", required=False)
+    @command.argument("time", required=False)
+    @command.argument("run_interval", required=False)
+    @command.argument("max_random_delay", required=False)
+    async def schedule(self, evt: MessageEvent, prompt_name: str, date: Optional[str], time: Optional[str], run_interval: Optional[str], max_random_delay: Optional[str]) -> None:
+        if not self.is_allowed(evt.sender):
+            self.log.warn(f"stranger danger: sender={evt.sender}")
+            return
+        room = await self.get_room(evt.room_id)
+        prompt = await db.fetch_prompt(self.database, room.room_id, prompt_name)
+        if prompt is None:
+            await evt.mark_read()
+            await evt.reply("You must create the prompt with the !prompt command first.")
+            return
+
+        if not await self.apply_schedule(evt, room, prompt, date, time, run_interval, max_random_delay):
+            return
         await db.upsert_prompt(self.database, prompt)
         await evt.mark_read()
         await evt.react("✅")
 
+    @lt_command.subcommand(help="Create a new group prompt, shared by many rooms, or update its message template.")
+    @command.argument("group_name")
+    @command.argument("message_template", pass_raw=True)
+    async def group(self, evt: MessageEvent, group_name: str, message_template: str) -> None:
+        if not self.is_allowed(evt.sender):
+            self.log.warn(f"stranger danger: sender={evt.sender}")
+            return
+        group = await db.fetch_group(self.database, group_name)
+        if group is None:
+            group = db.Group(group_name, message_template)
+        else:
+            group.message_template = message_template
+        await db.upsert_group(self.database, group)
+        self.templates.pop((None, group_name), None)
+        await evt.mark_read()
+        await evt.react("✅")
+
+    @lt_command.subcommand(help="Delete the specified group prompt (if it exists) and its room memberships.")
+    @command.argument("group_name")
+    async def rmgroup(self, evt: MessageEvent, group_name: str) -> None:
+        if not self.is_allowed(evt.sender):
+            self.log.warn(f"stranger danger: sender={evt.sender}")
+            return
+        await db.delete_group(self.database, group_name)
+        self.templates.pop((None, group_name), None)
+        await evt.mark_read()
+        await evt.react("✅")
+
+    @lt_command.subcommand(help="Add the current room to a group prompt.")
+    @command.argument("group_name")
+    async def join(self, evt: MessageEvent, group_name: str) -> None:
+        if not self.is_allowed(evt.sender):
+            self.log.warn(f"stranger danger: sender={evt.sender}")
+            return
+        room = await self.get_room(evt.room_id)
+        group = await db.fetch_group(self.database, group_name)
+        if group is None:
+            await evt.mark_read()
+            await evt.reply("You must create the group with the !group command first.")
+            return
+        if await db.fetch_prompt(self.database, room.room_id, group.name) is not None:
+            await evt.mark_read()
+            await evt.reply("This room already has a prompt with that name; rename or remove it first.")
+            return
+        await db.add_group_room(self.database, group.name, room.room_id)
+        await evt.mark_read()
+        await evt.react("✅")
+
+    @lt_command.subcommand(help="Remove the current room from a group prompt.")
+    @command.argument("group_name")
+    async def leave(self, evt: MessageEvent, group_name: str) -> None:
+        if not self.is_allowed(evt.sender):
+            self.log.warn(f"stranger danger: sender={evt.sender}")
+            return
+        await db.remove_group_room(self.database, group_name, evt.room_id)
+        await evt.mark_read()
+        await evt.react("✅")
+
+    @lt_command.subcommand(help="Set the next run date and time, run interval, and random delay for a group prompt.")
+    @command.argument("group_name")
+    @command.argument("date", required=False)
+    @command.argument("time", required=False)
+    @command.argument("run_interval", required=False)
+    @command.argument("max_random_delay", required=False)
+    async def groupschedule(self, evt: MessageEvent, group_name: str, date: Optional[str], time: Optional[str], run_interval: Optional[str], max_random_delay: Optional[str]) -> None:
+        if not self.is_allowed(evt.sender):
+            self.log.warn(f"stranger danger: sender={evt.sender}")
+            return
+        room = await self.get_room(evt.room_id)
+        group = await db.fetch_group(self.database, group_name)
+        if group is None:
+            await evt.mark_read()
+            await evt.reply("You must create the group with the !group command first.")
+            return
+
+        if not await self.apply_schedule(evt, room, group, date, time, run_interval, max_random_delay):
+            return
+        await db.upsert_group(self.database, group)
+        await evt.mark_read()
+        await evt.react("✅")
+
 
     @event.on(EventType.ROOM_MESSAGE)
     async def handle_msg(self, evt: MessageEvent) -> None:
@@ -1,11 +1,14 @@
 from mautrix.util.async_db import UpgradeTable, Connection, Database
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Dict
 from zoneinfo import ZoneInfo
 from datetime import datetime, timedelta, timezone
+import logging
 
 
 DB_DATETIME_FMT = "%Y-%m-%d %H:%M:%S"
 
+log = logging.getLogger(__name__)
+
 
 upgrade_table = UpgradeTable()
 
@@ -54,6 +57,104 @@ async def upgrade_v1(conn: Connection) -> None:
     )
 
 
+@upgrade_table.register(description="v2: indexes for history pagination")
+async def upgrade_v2(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE INDEX outreaches_room_prompt_timestamp ON outreaches (room_id, prompt_name, timestamp_utc, event_id)"""
+    )
+    await conn.execute(
+        """CREATE INDEX responses_room_outreach ON responses (room_id, outreach_event_id)"""
+    )
+
+
+@upgrade_table.register(description="v3: groups")
+async def upgrade_v3(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE groups (
+          name TEXT NOT NULL PRIMARY KEY,
+          message_template TEXT NOT NULL,
+          next_run_utc TEXT,
+          run_interval_sec INTEGER,
+          max_random_delay_sec INTEGER
+        )"""
+    )
+    await conn.execute(
+        """CREATE TABLE group_rooms (
+          group_name TEXT NOT NULL,
+          room_id TEXT NOT NULL,
+          PRIMARY KEY (group_name, room_id),
+          FOREIGN KEY (group_name) REFERENCES groups(name),
+          FOREIGN KEY (room_id) REFERENCES rooms(id)
+        )"""
+    )
+
+
+@upgrade_table.register(description="v4: prompt stats")
+async def upgrade_v4(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE prompt_stats (
+          room_id TEXT NOT NULL,
+          prompt_name TEXT NOT NULL,
+          streak INTEGER NOT NULL,
+          last_response TEXT,
+          last_response_utc TEXT,
+          last_outreach_event_id TEXT,
+          last_outreach_answered INTEGER NOT NULL,
+          PRIMARY KEY (room_id, prompt_name),
+          FOREIGN KEY (room_id) REFERENCES rooms(id)
+        )"""
+    )
+    # Group sends look up stats for every member room by prompt name
+    await conn.execute(
+        """CREATE INDEX prompt_stats_prompt_room ON prompt_stats (prompt_name, room_id)"""
+    )
+
+    # Populate the stats from existing data by replaying outreaches in order. As in insert_response, only a response that
+    # arrived while an outreach was still the latest one counts toward the streak.
+    outreaches_by_key = {}
+    rows = await conn.fetch(
+        """SELECT room_id, prompt_name, event_id, timestamp_utc,
+            (SELECT MIN(timestamp_utc) FROM responses WHERE responses.room_id = outreaches.room_id AND responses.outreach_event_id = outreaches.event_id) AS first_response_utc
+        FROM outreaches ORDER BY room_id, prompt_name, timestamp_utc, event_id"""
+    )
+    for row in rows:
+        outreaches_by_key.setdefault((row["room_id"], row["prompt_name"]), []).append(row)
+    stats = {}
+    for key, outreach_rows in outreaches_by_key.items():
+        streak = 0
+        answered = False
+        for index, row in enumerate(outreach_rows):
+            if index > 0 and not answered:
+                streak = 0
+            next_outreach_utc = outreach_rows[index + 1]["timestamp_utc"] if index + 1 < len(outreach_rows) else None
+            answered = row["first_response_utc"] is not None and (next_outreach_utc is None or row["first_response_utc"] < next_outreach_utc)
+            if answered:
+                streak += 1
+        stats[key] = (streak, None, None, outreach_rows[-1]["event_id"], 1 if answered else 0)
+    rows = await conn.fetch(
+        """SELECT responses.room_id, outreaches.prompt_name, responses.message, responses.timestamp_utc
+        FROM responses JOIN outreaches ON responses.room_id = outreaches.room_id AND responses.outreach_event_id = outreaches.event_id
+        ORDER BY responses.timestamp_utc, responses.event_id"""
+    )
+    for row in rows:
+        key = (row["room_id"], row["prompt_name"])
+        streak, _, _, last_outreach_event_id, last_outreach_answered = stats[key]
+        stats[key] = (streak, row["message"], row["timestamp_utc"], last_outreach_event_id, last_outreach_answered)
+    if stats:
+        await conn.executemany(
+            """INSERT INTO prompt_stats(room_id, prompt_name, streak, last_response, last_response_utc, last_outreach_event_id, last_outreach_answered)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)""",
+            [key + value for key, value in stats.items()],
+        )
+
+
+@upgrade_table.register(description="v5: index for startup backfill")
+async def upgrade_v5(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE INDEX outreaches_timestamp ON outreaches (timestamp_utc)"""
+    )
+
+
 class Room:
     def __init__(self, room_id: str, tz: ZoneInfo = None) -> None:
         self.room_id = room_id
@@ -70,6 +171,15 @@ class Prompt:
         self.max_random_delay = max_random_delay
 
 
+class Group:
+    def __init__(self, name: str, message_template: str, next_run: datetime = None, run_interval: timedelta = None, max_random_delay: timedelta = None) -> None:
+        self.name = name
+        self.message_template = message_template
+        self.next_run = next_run
+        self.run_interval = run_interval
+        self.max_random_delay = max_random_delay
+
+
 class Outreach:
     def __init__(self, room_id: str, event_id: str, prompt_name: str, timestamp: datetime, message: str) -> None:
         self.room_id = room_id
@@ -88,20 +198,50 @@ class Response:
         self.message = message
 
 
+class PromptStats:
+    def __init__(self, room_id: str, prompt_name: str, streak: int = 0, last_response: str = None, last_response_time: datetime = None, last_outreach_event_id: str = None, last_outreach_answered: bool = False) -> None:
+        self.room_id = room_id
+        self.prompt_name = prompt_name
+        self.streak = streak
+        self.last_response = last_response
+        self.last_response_time = last_response_time
+        self.last_outreach_event_id = last_outreach_event_id
+        self.last_outreach_answered = last_outreach_answered
+
+    @property
+    def current_streak(self) -> int:
+        # The stored streak is only reset when the next outreach goes out, so an unanswered outreach breaks it here
+        if self.last_outreach_event_id and not self.last_outreach_answered:
+            return 0
+        return self.streak
+
+
+def _parse_tz(tzkey: Optional[str]) -> Optional[ZoneInfo]:
+    if not tzkey:
+        return None
+    try:
+        return ZoneInfo(tzkey)
+    except Exception as e:
+        log.warning(f"ignoring invalid timezone {tzkey!r}: {e}")
+        return None
+
+
+def _load_schedule(item: Prompt | Group, row) -> None:
+    if row["next_run_utc"]:
+        item.next_run = datetime.strptime(row["next_run_utc"], DB_DATETIME_FMT).replace(tzinfo=timezone.utc)
+    if row["run_interval_sec"]:
+        item.run_interval = timedelta(seconds=row["run_interval_sec"])
+    if row["max_random_delay_sec"]:
+        item.max_random_delay = timedelta(seconds=row["max_random_delay_sec"])
+
+
 async def fetch_room(db: Database, room_id: str) -> Optional[Room]:
     q = "SELECT tz FROM rooms WHERE id=$1"
     row = await db.fetchrow(q, room_id)
     if not row:
         return None
 
-    tz = None
-    try:
-        tz = ZoneInfo(row["tz"])
-    except:
-        # TODO log
-        pass
-    
-    return Room(room_id, tz)
+    return Room(room_id, _parse_tz(row["tz"]))
 
 
 async def upsert_room(db: Database, room: Room) -> None:
@@ -122,12 +262,7 @@ async def fetch_prompt(db: Database, room_id: str, name: str) -> Optional[Prompt
         return None
 
     prompt = Prompt(room_id, name, row["message_template"])
-    if row["next_run_utc"]:
-        prompt.next_run = datetime.strptime(row["next_run_utc"], DB_DATETIME_FMT).replace(tzinfo=timezone.utc)
-    if row["run_interval_sec"]:
-        prompt.run_interval = timedelta(seconds=row["run_interval_sec"])
-    if row["max_random_delay_sec"]:
-        prompt.max_random_delay = timedelta(seconds=row["max_random_delay_sec"])
+    _load_schedule(prompt, row)
     return prompt
 
 
@@ -152,12 +287,7 @@ async def fetch_prompts(db: Database, room_id: Optional[str] = None, due: Option
     results = []
     for row in rows:
         prompt = Prompt(row["room_id"], row["name"], row["message_template"])
-        if row["next_run_utc"]:
-            prompt.next_run = datetime.strptime(row["next_run_utc"], DB_DATETIME_FMT).replace(tzinfo=timezone.utc)
-        if row["run_interval_sec"]:
-            prompt.run_interval = timedelta(seconds=row["run_interval_sec"])
-        if row["max_random_delay_sec"]:
-            prompt.max_random_delay = timedelta(seconds=row["max_random_delay_sec"])
+        _load_schedule(prompt, row)
         results.append(prompt)
     return results
 
@@ -184,9 +314,95 @@ async def delete_prompt(db: Database, room_id: str, name: str) -> None:
     await db.execute(q, room_id, name)
 
 
+async def fetch_group(db: Database, name: str) -> Optional[Group]:
+    q = "SELECT message_template, next_run_utc, run_interval_sec, max_random_delay_sec FROM groups WHERE name=$1"
+    row = await db.fetchrow(q, name)
+    if not row:
+        return None
+
+    group = Group(name, row["message_template"])
+    _load_schedule(group, row)
+    return group
+
+
+async def fetch_groups(db: Database, room_id: Optional[str] = None, due: Optional[datetime] = None) -> List[Group]:
+    q = "SELECT name, message_template, next_run_utc, run_interval_sec, max_random_delay_sec FROM groups WHERE "
+
+    argnum = 1
+    args = []
+    if due is not None:
+        args.append(due.strftime(DB_DATETIME_FMT))
+        q += f"next_run_utc IS NOT NULL AND DATETIME(next_run_utc) <= DATETIME(${argnum}) AND "
+        argnum += 1
+    if room_id is not None:
+        args.append(room_id)
+        q += f"name IN (SELECT group_name FROM group_rooms WHERE room_id = ${argnum}) AND "
+        argnum += 1
+
+    q = q.removesuffix(" WHERE ").removesuffix(" AND ")
+
+    rows = await db.fetch(q, *args)
+
+    results = []
+    for row in rows:
+        group = Group(row["name"], row["message_template"])
+        _load_schedule(group, row)
+        results.append(group)
+    return results
+
+
+async def upsert_group(db: Database, group: Group) -> None:
+    q = """
+        INSERT INTO groups(name, message_template, next_run_utc, run_interval_sec, max_random_delay_sec) VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (name) DO UPDATE SET message_template=excluded.message_template, next_run_utc=excluded.next_run_utc, run_interval_sec=excluded.run_interval_sec, max_random_delay_sec=excluded.max_random_delay_sec
+    """
+    next_run_utc = None
+    if group.next_run:
+        next_run_utc = group.next_run.astimezone(timezone.utc).strftime(DB_DATETIME_FMT)
+    run_interval_sec = None
+    if group.run_interval:
+        run_interval_sec = group.run_interval.total_seconds()
+    max_random_delay_sec = None
+    if group.max_random_delay:
+        max_random_delay_sec = group.max_random_delay.total_seconds()
+    await db.execute(q, group.name, group.message_template, next_run_utc, run_interval_sec, max_random_delay_sec)
+
+
+async def delete_group(db: Database, name: str) -> None:
+    await db.execute("DELETE FROM group_rooms WHERE group_name=$1", name)
+    await db.execute("DELETE FROM groups WHERE name=$1", name)
+
+
+async def add_group_room(db: Database, name: str, room_id: str) -> None:
+    q = "INSERT INTO group_rooms(group_name, room_id) VALUES ($1, $2) ON CONFLICT (group_name, room_id) DO NOTHING"
+    await db.execute(q, name, room_id)
+
+
+async def remove_group_room(db: Database, name: str, room_id: str) -> None:
+    q = "DELETE FROM group_rooms WHERE group_name=$1 AND room_id=$2"
+    await db.execute(q, name, room_id)
+
+
+async def fetch_group_rooms(db: Database, name: str) -> List[Room]:
+    q = "SELECT rooms.id, rooms.tz FROM group_rooms JOIN rooms ON group_rooms.room_id = rooms.id WHERE group_rooms.group_name = $1 ORDER BY rooms.id"
+    rows = await db.fetch(q, name)
+    results = []
+    for row in rows:
+        results.append(Room(row["id"], _parse_tz(row["tz"])))
+    return results
+
+
 async def insert_outreach(db: Database, outreach: Outreach) -> None:
     q = "INSERT INTO outreaches(room_id, event_id, prompt_name, timestamp_utc, message) VALUES ($1, $2, $3, $4, $5)"
     await db.execute(q, outreach.room_id, outreach.event_id, outreach.prompt_name, outreach.timestamp.astimezone(timezone.utc).strftime(DB_DATETIME_FMT), outreach.message)
+    q = """
+        INSERT INTO prompt_stats(room_id, prompt_name, streak, last_outreach_event_id, last_outreach_answered) VALUES ($1, $2, 0, $3, 0)
+        ON CONFLICT (room_id, prompt_name) DO UPDATE SET
+            streak=CASE WHEN prompt_stats.last_outreach_event_id IS NOT NULL AND prompt_stats.last_outreach_answered = 0 THEN 0 ELSE prompt_stats.streak END,
+            last_outreach_event_id=excluded.last_outreach_event_id,
+            last_outreach_answered=0
+    """
+    await db.execute(q, outreach.room_id, outreach.prompt_name, outreach.event_id)
 
 
 async def fetch_outreach(db: Database, room_id: str, event_id: str) -> Optional[Outreach]:
@@ -197,9 +413,71 @@ async def fetch_outreach(db: Database, room_id: str, event_id: str) -> Optional[
     return Outreach(room_id, event_id, row["prompt_name"], datetime.strptime(row["timestamp_utc"], DB_DATETIME_FMT).replace(tzinfo=timezone.utc), row["message"])
 
 
+# Only the first response to the latest outreach extends the streak; last_response tracks the newest response of any outreach
+RESPONSE_STATS_Q = """
+    INSERT INTO prompt_stats(room_id, prompt_name, streak, last_response, last_response_utc, last_outreach_answered)
+    SELECT room_id, prompt_name, 0, $3, $4, 0 FROM outreaches WHERE room_id=$1 AND event_id=$2
+    ON CONFLICT (room_id, prompt_name) DO UPDATE SET
+        streak=CASE WHEN prompt_stats.last_outreach_event_id = $2 AND prompt_stats.last_outreach_answered = 0 THEN prompt_stats.streak + 1 ELSE prompt_stats.streak END,
+        last_outreach_answered=CASE WHEN prompt_stats.last_outreach_event_id = $2 THEN 1 ELSE prompt_stats.last_outreach_answered END,
+        last_response=CASE WHEN prompt_stats.last_response_utc IS NULL OR prompt_stats.last_response_utc <= excluded.last_response_utc THEN excluded.last_response ELSE prompt_stats.last_response END,
+        last_response_utc=CASE WHEN prompt_stats.last_response_utc IS NULL OR prompt_stats.last_response_utc <= excluded.last_response_utc THEN excluded.last_response_utc ELSE prompt_stats.last_response_utc END
+"""
+
+
 async def insert_response(db: Database, response: Response) -> None:
-    q = "INSERT INTO responses(room_id, event_id, outreach_event_id, timestamp_utc, message) VALUES ($1, $2, $3, $4, $5)"
-    await db.execute(q, response.room_id, response.event_id, response.outreach_event_id, response.timestamp.astimezone(timezone.utc).strftime(DB_DATETIME_FMT), response.message)
+    # The startup backfill may already have recorded the response; the stats update is idempotent for it
+    q = "INSERT INTO responses(room_id, event_id, outreach_event_id, timestamp_utc, message) VALUES ($1, $2, $3, $4, $5) ON CONFLICT (room_id, event_id) DO NOTHING"
+    timestamp_utc = response.timestamp.astimezone(timezone.utc).strftime(DB_DATETIME_FMT)
+    await db.execute(q, response.room_id, response.event_id, response.outreach_event_id, timestamp_utc, response.message)
+    await db.execute(RESPONSE_STATS_Q, response.room_id, response.outreach_event_id, response.message, timestamp_utc)
+
+
+async def insert_responses(db: Database, responses: List[Response]) -> None:
+    q = "INSERT INTO responses(room_id, event_id, outreach_event_id, timestamp_utc, message) VALUES ($1, $2, $3, $4, $5) ON CONFLICT (room_id, event_id) DO NOTHING"
+    records = [(r.room_id, r.event_id, r.outreach_event_id, r.timestamp.astimezone(timezone.utc).strftime(DB_DATETIME_FMT), r.message) for r in responses]
+    await db.executemany(q, records)
+    await db.executemany(RESPONSE_STATS_Q, [(room_id, outreach_event_id, message, timestamp_utc) for room_id, _, outreach_event_id, timestamp_utc, message in records])
+
+
+async def fetch_recent_outreaches(db: Database, since: datetime) -> List[Outreach]:
+    q = "SELECT room_id, event_id, prompt_name, timestamp_utc, message FROM outreaches WHERE timestamp_utc >= $1 ORDER BY timestamp_utc"
+    rows = await db.fetch(q, since.astimezone(timezone.utc).strftime(DB_DATETIME_FMT))
+    return [Outreach(row["room_id"], row["event_id"], row["prompt_name"], datetime.strptime(row["timestamp_utc"], DB_DATETIME_FMT).replace(tzinfo=timezone.utc), row["message"]) for row in rows]
+
+
+async def fetch_response_times(db: Database, room_id: str, outreach_event_ids: List[str]) -> Dict[str, datetime]:
+    if not outreach_event_ids:
+        return {}
+    placeholders = ", ".join(f"${i + 2}" for i in range(len(outreach_event_ids)))
+    q = f"SELECT event_id, timestamp_utc FROM responses WHERE room_id = $1 AND outreach_event_id IN ({placeholders})"
+    rows = await db.fetch(q, room_id, *outreach_event_ids)
+    return {row["event_id"]: datetime.strptime(row["timestamp_utc"], DB_DATETIME_FMT).replace(tzinfo=timezone.utc) for row in rows}
+
+
+def _prompt_stats_from_row(row) -> PromptStats:
+    stats = PromptStats(row["room_id"], row["prompt_name"], row["streak"], row["last_response"], None, row["last_outreach_event_id"], bool(row["last_outreach_answered"]))
+    if row["last_response_utc"]:
+        stats.last_response_time = datetime.strptime(row["last_response_utc"], DB_DATETIME_FMT).replace(tzinfo=timezone.utc)
+    return stats
+
+
+async def fetch_prompt_stats(db: Database, room_id: str, prompt_name: str) -> PromptStats:
+    q = "SELECT room_id, prompt_name, streak, last_response, last_response_utc, last_outreach_event_id, last_outreach_answered FROM prompt_stats WHERE room_id=$1 AND prompt_name=$2"
+    row = await db.fetchrow(q, room_id, prompt_name)
+    if not row:
+        return PromptStats(room_id, prompt_name)
+    return _prompt_stats_from_row(row)
+
+
+async def fetch_group_prompt_stats(db: Database, group_name: str) -> Dict[str, PromptStats]:
+    q = """
+        SELECT prompt_stats.room_id, prompt_stats.prompt_name, streak, last_response, last_response_utc, last_outreach_event_id, last_outreach_answered
+        FROM group_rooms JOIN prompt_stats ON prompt_stats.room_id = group_rooms.room_id AND prompt_stats.prompt_name = group_rooms.group_name
+        WHERE group_rooms.group_name = $1
+    """
+    rows = await db.fetch(q, group_name)
+    return {row["room_id"]: _prompt_stats_from_row(row) for row in rows}
 
 
 async def fetch_outreaches_and_responses(db: Database, room_id: str) -> List[Tuple[Outreach, List[Response]]]:
@@ -224,3 +502,34 @@ async def fetch_outreaches_and_responses(db: Database, room_id: str) -> List[Tup
             response = Response(room_id, row["rid"], outreach_event_id, datetime.strptime(row["rtc"], DB_DATETIME_FMT).replace(tzinfo=timezone.utc), row["rm"])
             outreach_responses[outreach_event_id].append(response)
     return [(o, outreach_responses[o.event_id]) for o in outreaches_by_id.values()]
+
+
+async def fetch_history(db: Database, room_id: str, prompt_name: str, limit: int, before: Optional[Outreach] = None) -> List[Tuple[Outreach, List[Response]]]:
+    # Keyset pagination: pass the oldest outreach from the previous page as `before`.
+    # Timestamps are compared as plain strings (DB_DATETIME_FMT sorts lexicographically) so the index can be used.
+    q = "SELECT event_id, timestamp_utc, message FROM outreaches WHERE room_id = $1 AND prompt_name = $2 "
+    args = [room_id, prompt_name]
+    if before is not None:
+        args.append(before.timestamp.astimezone(timezone.utc).strftime(DB_DATETIME_FMT))
+        args.append(before.event_id)
+        q += "AND (timestamp_utc, event_id) < ($3, $4) "
+    args.append(limit)
+    q += f"ORDER BY timestamp_utc DESC, event_id DESC LIMIT ${len(args)}"
+    rows = await db.fetch(q, *args)
+    if not rows:
+        return []
+
+    outreaches = [Outreach(room_id, row["event_id"], prompt_name, datetime.strptime(row["timestamp_utc"], DB_DATETIME_FMT).replace(tzinfo=timezone.utc), row["message"]) for row in rows]
+    outreach_responses = {o.event_id: [] for o in outreaches}
+
+    placeholders = ", ".join(f"${i + 2}" for i in range(len(outreaches)))
+    q = f"""
+        SELECT event_id, outreach_event_id, timestamp_utc, message FROM responses
+        WHERE room_id = $1 AND outreach_event_id IN ({placeholders})
+        ORDER BY timestamp_utc, event_id
+    """
+    rows = await db.fetch(q, room_id, *outreach_responses.keys())
+    for row in rows:
+        response = Response(room_id, row["event_id"], row["outreach_event_id"], datetime.strptime(row["timestamp_utc"], DB_DATETIME_FMT).replace(tzinfo=timezone.utc), row["message"])
+        outreach_responses[row["outreach_event_id"]].append(response)
+    return [(o, outreach_responses[o.event_id]) for o in outreaches]
@@ -1,6 +1,6 @@
 from datetime import datetime, tzinfo, timedelta
 import re
-from typing import List, Tuple
+from typing import List, Tuple, Optional, Union
 from maubot_life_tracking import db
 import csv
 from io import StringIO
@@ -8,6 +8,10 @@ from io import StringIO
 
 DATETIME_RE = re.compile(r"(today|tom|tomorrow|\d\d\d\d-\d\d-\d\d)\s+\d\d\:\d\d")
 INTERVAL_RE = re.compile(r"(\d+)(d|h|m|s)")
+MAX_MESSAGE_LENGTH = 4000
+TEMPLATE_VARIABLE_RE = re.compile(r"\$\((\w+)\)")
+STATS_VARIABLES = {"streak", "last_response", "days_since_last"}
+TEMPLATE_VARIABLES = {"date"} | STATS_VARIABLES
 
 
 def parse_datetime(inp: str, tz: tzinfo) -> datetime:
@@ -39,9 +43,62 @@ def parse_interval(inp: str) -> timedelta:
     return timedelta(days=n)
 
 
-def render_template(template: str, now: datetime) -> str:
-    date = now.strftime("%A, %B %-d, %Y")
-    return template.replace("$(date)", date)
+class Variable:
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+
+class CompiledTemplate:
+    def __init__(self, source: str, parts: List[Union[str, Variable]]) -> None:
+        self.source = source
+        self.parts = parts
+        self.uses_stats = any(isinstance(part, Variable) and part.name in STATS_VARIABLES for part in parts)
+
+    def render(self, now: datetime, stats: Optional[db.PromptStats] = None) -> str:
+        out = []
+        for part in self.parts:
+            if isinstance(part, Variable):
+                out.append(render_variable(part.name, now, stats))
+            else:
+                out.append(part)
+        return "".join(out)
+
+
+def compile_template(template: str) -> CompiledTemplate:
+    parts = []
+    pos = 0
+    for match in TEMPLATE_VARIABLE_RE.finditer(template):
+        # Unknown variables are left in the output as-is
+        if match.group(1) not in TEMPLATE_VARIABLES:
+            continue
+        if match.start() > pos:
+            parts.append(template[pos:match.start()])
+        parts.append(Variable(match.group(1)))
+        pos = match.end()
+    if pos < len(template):
+        parts.append(template[pos:])
+    return CompiledTemplate(template, parts)
+
+
+def render_variable(name: str, now: datetime, stats: Optional[db.PromptStats]) -> str:
+    if name == "date":
+        return now.strftime("%A, %B %-d, %Y")
+    if stats is None:
+        stats = db.PromptStats(None, None)
+    if name == "streak":
+        return str(stats.current_streak)
+    if name == "last_response":
+        return stats.last_response or ""
+    if name == "days_since_last":
+        if stats.last_response_time is None:
+            return "never"
+        # Calendar days in the room's timezone, so yesterday evening is 1 even if it was less than 24 hours ago
+        return str((now.date() - stats.last_response_time.astimezone(now.tzinfo).date()).days)
+    raise ValueError(f"unknown template variable: {name}")
+
+
+def render_template(template: str, now: datetime, stats: Optional[db.PromptStats] = None) -> str:
+    return compile_template(template).render(now, stats)
 
 
 def render_csv(ors: List[Tuple[db.Outreach, List[db.Response]]]) -> str:
@@ -68,3 +125,29 @@ def render_csv(ors: List[Tuple[db.Outreach, List[db.Response]]]) -> str:
             )
             writer.writerow(row)
     return out.getvalue()
+
+
+def render_history(ors: List[Tuple[db.Outreach, List[db.Response]]], tz: tzinfo) -> List[str]:
+    lines = []
+    for outreach, responses in ors:
+        lines.append(f"- {outreach.timestamp.astimezone(tz).strftime('%Y-%m-%d %H:%M')}: {outreach.message}")
+        if not responses:
+            lines.append("  - (no response)")
+        for response in responses:
+            lines.append(f"  - {response.timestamp.astimezone(tz).strftime('%Y-%m-%d %H:%M')}: {response.message}")
+    return lines
+
+
+def chunk_lines(lines: List[str], max_length: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    chunks = []
+    current = ""
+    for line in lines:
+        if len(line) > max_length:
+            line = line[:max_length - 1] + "…"
+        if current and len(current) + 1 + len(line) > max_length:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
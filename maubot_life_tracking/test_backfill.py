@@ -0,0 +1,247 @@
+import unittest
+from pathlib import Path
+from typing import Dict, List, Optional
+from mautrix.types import Event, PaginatedMessages, PaginationDirection
+from mautrix.util.async_db import Database
+from maubot_life_tracking.db import upgrade_table, upsert_room, Room, Prompt, upsert_prompt, Outreach, insert_outreach, Response, insert_response, fetch_outreaches_and_responses, fetch_prompt_stats
+from maubot_life_tracking.backfill import backfill_responses
+from maubot_life_tracking.bot import LifeTrackingBot
+from datetime import datetime, timedelta, timezone
+import logging
+
+DB_PATH = Path("test.sqlite3")
+DB_FILES = [DB_PATH, Path("test.sqlite3-shm"), Path("test.sqlite3-wal")]
+DB_URI = f"sqlite:///{DB_PATH.resolve()}"
+
+START = datetime(2024, 5, 1, 17, 0, tzinfo=timezone.utc)
+
+
+def reply(room_id: str, event_id: str, sender: str, ts: datetime, outreach_event_id: str, body: str) -> Event:
+    return Event.deserialize({
+        "type": "m.room.message",
+        "event_id": event_id,
+        "room_id": room_id,
+        "sender": sender,
+        "origin_server_ts": int(ts.timestamp() * 1000),
+        "content": {"msgtype": "m.text", "body": body, "m.relates_to": {"m.in_reply_to": {"event_id": outreach_event_id}}},
+    })
+
+
+def reaction(room_id: str, event_id: str, sender: str, ts: datetime, outreach_event_id: str, key: str) -> Event:
+    return Event.deserialize({
+        "type": "m.reaction",
+        "event_id": event_id,
+        "room_id": room_id,
+        "sender": sender,
+        "origin_server_ts": int(ts.timestamp() * 1000),
+        "content": {"m.relates_to": {"rel_type": "m.annotation", "event_id": outreach_event_id, "key": key}},
+    })
+
+
+def encrypted(room_id: str, event_id: str, sender: str, ts: datetime) -> Event:
+    return Event.deserialize({
+        "type": "m.room.encrypted",
+        "event_id": event_id,
+        "room_id": room_id,
+        "sender": sender,
+        "origin_server_ts": int(ts.timestamp() * 1000),
+        "content": {"algorithm": "m.megolm.v1.aes-sha2", "ciphertext": event_id, "session_id": "s", "sender_key": "k", "device_id": "D"},
+    })
+
+
+class FakeCrypto:
+    def __init__(self, plaintext: Dict[str, Event]) -> None:
+        # Decrypted events keyed by the encrypted event ID
+        self.plaintext = plaintext
+
+    async def decrypt_megolm_event(self, evt: Event) -> Event:
+        if evt.event_id not in self.plaintext:
+            raise ValueError("unknown session")
+        return self.plaintext[evt.event_id]
+
+
+class FakeClient:
+    def __init__(self, events: Dict[str, List[Event]]) -> None:
+        # Events for each room, oldest first
+        self.events = events
+        self.requests = []
+        self.sent = []
+        self.on_send = None
+
+    async def get_messages(self, room_id: str, direction: PaginationDirection, from_token: Optional[str] = None, limit: Optional[int] = None, filter_json: Optional[dict] = None) -> PaginatedMessages:
+        self.requests.append((room_id, from_token, limit))
+        newest_first = list(reversed(self.events.get(room_id, [])))
+        start = int(from_token or 0)
+        end = start + limit
+        page = newest_first[start:end]
+        return PaginatedMessages(str(start), str(end) if end < len(newest_first) else None, page)
+
+    async def send_text(self, room_id: str, text: str) -> str:
+        self.sent.append((room_id, text))
+        if self.on_send:
+            self.on_send()
+        return f"sent{len(self.sent)}"
+
+
+class TestBackfill(unittest.IsolatedAsyncioTestCase):
+    async def test_backfill_responses(self) -> None:
+        db = Database.create(DB_URI, upgrade_table=upgrade_table)
+        await db.start()
+        try:
+            await upsert_room(db, Room("a"))
+            await upsert_room(db, Room("b"))
+            await insert_outreach(db, Outreach("a", "o1", "foo", START, "?"))
+            await insert_response(db, Response("a", "r1", "o1", START + timedelta(minutes=1), "seen live"))
+            await insert_outreach(db, Outreach("a", "o2", "foo", START + timedelta(days=1), "?"))
+            await insert_outreach(db, Outreach("b", "o3", "bar", START + timedelta(days=1), "?"))
+            # Too old to be considered
+            await insert_outreach(db, Outreach("b", "o0", "bar", START - timedelta(days=30), "?"))
+
+            client = FakeClient({
+                "a": [
+                    reply("a", "r0", "@me:x", START - timedelta(minutes=1), "o1", "before cutoff"),
+                    reply("a", "r1", "@me:x", START + timedelta(minutes=1), "o1", "seen live"),
+                    reply("a", "r2", "@me:x", START + timedelta(days=1, minutes=1), "o2", "missed"),
+                    reply("a", "x1", "@stranger:x", START + timedelta(days=1, minutes=2), "o2", "not allowed"),
+                    reply("a", "x2", "@me:x", START + timedelta(days=1, minutes=3), "nope", "not an outreach"),
+                    reaction("a", "r3", "@me:x", START + timedelta(days=1, minutes=4), "o2", "👍"),
+                    reaction("a", "x3", "@me:x", START + timedelta(days=3), "o2", "after startup"),
+                ],
+                "b": [
+                    reaction("b", "x4", "@me:x", START - timedelta(days=29), "o0", "👍"),
+                ] + [
+                    reaction("b", f"r{i}", "@me:x", START + timedelta(days=1, minutes=i), "o3", str(i)) for i in range(10, 15)
+                ],
+            })
+            count = await backfill_responses(
+                client,
+                db,
+                lambda sender: sender == "@me:x",
+                since=START - timedelta(days=1),
+                until=START + timedelta(days=2),
+                batch_size=2,
+                max_pages=10,
+            )
+            self.assertEqual(count, 7)
+
+            ors = await fetch_outreaches_and_responses(db, "a")
+            responses = {o.event_id: [r.message for r in rs] for o, rs in ors}
+            self.assertEqual(responses["o1"], ["seen live"])
+            self.assertEqual(responses["o2"], ["missed", "👍"])
+            ors = await fetch_outreaches_and_responses(db, "b")
+            responses = {o.event_id: [r.message for r in rs] for o, rs in ors}
+            self.assertEqual(responses["o0"], [])
+            self.assertEqual(responses["o3"], ["10", "11", "12", "13", "14"])
+
+            stats = await fetch_prompt_stats(db, "a", "foo")
+            self.assertEqual(stats.current_streak, 2)
+            self.assertEqual(stats.last_response, "👍")
+
+            # Paging stops once it reaches events older than the newest recorded response
+            client.requests = []
+            self.assertEqual(await backfill_responses(client, db, lambda sender: True, since=START - timedelta(days=1), until=START + timedelta(days=2), batch_size=2), 0)
+            self.assertEqual([r for r in client.requests if r[0] == "a"], [("a", None, 2), ("a", "2", 2)])
+        finally:
+            await db.stop()
+            for path in DB_FILES:
+                if path.exists():
+                    path.unlink()
+
+    async def test_backfill_before_outreach(self) -> None:
+        db = Database.create(DB_URI, upgrade_table=upgrade_table)
+        await db.start()
+        try:
+            now = datetime.now(timezone.utc).replace(microsecond=0)
+            await upsert_room(db, Room("a"))
+            await insert_outreach(db, Outreach("a", "o1", "foo", now - timedelta(days=2), "?"))
+            await insert_response(db, Response("a", "r1", "o1", now - timedelta(days=2, minutes=-1), "seen live"))
+            await insert_outreach(db, Outreach("a", "o2", "foo", now - timedelta(days=1), "?"))
+            # Came due while the bot was offline
+            await upsert_prompt(db, Prompt("a", "foo", "streak: $(streak)", now - timedelta(hours=1), timedelta(days=1)))
+
+            client = FakeClient({
+                "a": [reply("a", "r2", "@me:x", now - timedelta(days=1, minutes=-1), "o2", "missed")],
+            })
+            bot = LifeTrackingBot.__new__(LifeTrackingBot)
+            bot.client = client
+            bot.database = db
+            bot.log = logging.getLogger(__name__)
+            bot.config = {
+                "allowlist": False,
+                "default_tz": "America/Los_Angeles",
+                "exec_frequency": "0s",
+                "backfill_lookback": "7d",
+                "backfill_batch_size": 10,
+                "backfill_max_pages": 10,
+                "backfill_concurrency": 5,
+            }
+            bot.templates = {}
+            bot.running = True
+
+            def stop() -> None:
+                bot.running = False
+            client.on_send = stop
+            await bot.run_loop()
+
+            self.assertEqual(client.sent, [("a", "streak: 2")])
+            stats = await fetch_prompt_stats(db, "a", "foo")
+            self.assertEqual(stats.streak, 2)
+            self.assertEqual(stats.last_outreach_event_id, "sent1")
+            self.assertEqual(stats.last_response, "missed")
+        finally:
+            await db.stop()
+            for path in DB_FILES:
+                if path.exists():
+                    path.unlink()
+
+    async def test_backfill_encrypted(self) -> None:
+        db = Database.create(DB_URI, upgrade_table=upgrade_table)
+        await db.start()
+        try:
+            await upsert_room(db, Room("a"))
+            await insert_outreach(db, Outreach("a", "o1", "foo", START, "?"))
+            events = {"a": [
+                encrypted("a", "e1", "@me:x", START + timedelta(minutes=1)),
+                encrypted("a", "e2", "@me:x", START + timedelta(minutes=2)),
+            ]}
+
+            client = FakeClient(events)
+            with self.assertLogs("backfill-test", level="WARNING") as logs:
+                count = await backfill_responses(client, db, lambda sender: True, since=START - timedelta(days=1), until=START + timedelta(days=1), log=logging.getLogger("backfill-test"))
+            self.assertEqual(count, 0)
+            self.assertIn("skipped 2 encrypted events", logs.output[0])
+
+            client = FakeClient(events)
+            client.crypto = FakeCrypto({"e1": reaction("a", "e1", "@me:x", START + timedelta(minutes=1), "o1", "👍")})
+            with self.assertLogs("backfill-test", level="WARNING") as logs:
+                count = await backfill_responses(client, db, lambda sender: True, since=START - timedelta(days=1), until=START + timedelta(days=1), log=logging.getLogger("backfill-test"))
+            self.assertEqual(count, 1)
+            self.assertIn("could not decrypt e2", logs.output[0])
+            ors = await fetch_outreaches_and_responses(db, "a")
+            self.assertEqual([r.message for r in ors[0][1]], ["👍"])
+        finally:
+            await db.stop()
+            for path in DB_FILES:
+                if path.exists():
+                    path.unlink()
+
+    async def test_backfill_max_pages(self) -> None:
+        db = Database.create(DB_URI, upgrade_table=upgrade_table)
+        await db.start()
+        try:
+            await upsert_room(db, Room("a"))
+            await insert_outreach(db, Outreach("a", "o1", "foo", START, "?"))
+            client = FakeClient({"a": [reaction("a", f"r{i}", "@me:x", START + timedelta(minutes=i), "o1", str(i)) for i in range(1, 6)]})
+            with self.assertLogs("backfill-test", level="WARNING") as logs:
+                count = await backfill_responses(client, db, lambda sender: True, since=START - timedelta(days=1), until=START + timedelta(days=1), batch_size=2, max_pages=2, log=logging.getLogger("backfill-test"))
+            self.assertEqual(count, 4)
+            self.assertIn("stopped after 2 pages", logs.output[0])
+        finally:
+            await db.stop()
+            for path in DB_FILES:
+                if path.exists():
+                    path.unlink()
+
+
+if __name__ == "__main__":
+    unittest.main()
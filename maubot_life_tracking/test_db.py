@@ -1,7 +1,7 @@
 import unittest
 from pathlib import Path
-from mautrix.util.async_db import Database
-from maubot_life_tracking.db import upgrade_table, fetch_room, upsert_room, Room, Prompt, fetch_prompt, upsert_prompt, delete_prompt, Outreach, insert_outreach, Response, insert_response, fetch_outreaches_and_responses, fetch_prompts, fetch_outreach
+from mautrix.util.async_db import Database, UpgradeTable
+from maubot_life_tracking.db import upgrade_table, fetch_room, upsert_room, Room, Prompt, fetch_prompt, upsert_prompt, delete_prompt, Outreach, insert_outreach, Response, insert_response, fetch_outreaches_and_responses, fetch_prompts, fetch_outreach, fetch_history, Group, fetch_group, fetch_groups, upsert_group, delete_group, add_group_room, remove_group_room, fetch_group_rooms, fetch_prompt_stats, fetch_group_prompt_stats
 from zoneinfo import ZoneInfo
 from datetime import datetime, timedelta, timezone
 
@@ -114,6 +114,213 @@ class TestDb(unittest.IsolatedAsyncioTestCase):
                 if path.exists():
                     path.unlink()
 
+    async def test_fetch_history(self) -> None:
+        db = Database.create(DB_URI, upgrade_table=upgrade_table)
+        await db.start()
+        try:
+            await upsert_room(db, Room("a"))
+            await upsert_room(db, Room("b"))
+            start = datetime(2024, 5, 1, 17, 0, tzinfo=timezone.utc)
+            for i in range(5):
+                await insert_outreach(db, Outreach("a", f"o{i}", "foo", start + timedelta(days=i), f"foo {i}"))
+            await insert_outreach(db, Outreach("a", "o5", "foo", start + timedelta(days=4), "foo 5"))
+            await insert_outreach(db, Outreach("a", "x1", "bar", start + timedelta(days=10), "bar"))
+            await insert_outreach(db, Outreach("b", "y1", "foo", start + timedelta(days=10), "other room"))
+            await insert_response(db, Response("a", "r1", "o3", start + timedelta(days=3, minutes=2), "second"))
+            await insert_response(db, Response("a", "r2", "o3", start + timedelta(days=3, minutes=1), "first"))
+
+            page = await fetch_history(db, "a", "foo", 3)
+            self.assertEqual([o.event_id for o, _ in page], ["o5", "o4", "o3"])
+            self.assertEqual(page[0][1], [])
+            self.assertEqual([r.message for r in page[2][1]], ["first", "second"])
+            self.assertEqual(page[2][0].timestamp, start + timedelta(days=3))
+
+            page = await fetch_history(db, "a", "foo", 3, page[-1][0])
+            self.assertEqual([o.event_id for o, _ in page], ["o2", "o1", "o0"])
+
+            page = await fetch_history(db, "a", "foo", 3, page[-1][0])
+            self.assertEqual(page, [])
+
+            # Ties on timestamp are broken by event ID
+            page = await fetch_history(db, "a", "foo", 1)
+            page = await fetch_history(db, "a", "foo", 1, page[-1][0])
+            self.assertEqual([o.event_id for o, _ in page], ["o4"])
+        finally:
+            await db.stop()
+            for path in DB_FILES:
+                if path.exists():
+                    path.unlink()
+
+    async def test_invalid_tz(self) -> None:
+        db = Database.create(DB_URI, upgrade_table=upgrade_table)
+        await db.start()
+        try:
+            await db.execute("INSERT INTO rooms(id, tz) VALUES ('a', 'Not/AZone')")
+            with self.assertLogs("maubot_life_tracking.db", level="WARNING"):
+                room = await fetch_room(db, "a")
+            self.assertEqual(None, room.tz)
+        finally:
+            await db.stop()
+            for path in DB_FILES:
+                if path.exists():
+                    path.unlink()
+
+    async def test_groups(self) -> None:
+        db = Database.create(DB_URI, upgrade_table=upgrade_table)
+        await db.start()
+        try:
+            await upsert_room(db, Room("a", ZONE))
+            await upsert_room(db, Room("b"))
+            self.assertEqual(None, await fetch_group(db, "g"))
+
+            now = datetime.now(timezone.utc).replace(microsecond=0)
+            await upsert_group(db, Group("g", "Check in", now, timedelta(days=1), timedelta(hours=1)))
+            await upsert_group(db, Group("h", "Other"))
+            group = await fetch_group(db, "g")
+            self.assertEqual(group.name, "g")
+            self.assertEqual(group.message_template, "Check in")
+            self.assertEqual(group.next_run, now)
+            self.assertEqual(group.run_interval, timedelta(days=1))
+            self.assertEqual(group.max_random_delay, timedelta(hours=1))
+
+            self.assertEqual([g.name for g in await fetch_groups(db, due=now + timedelta(seconds=10))], ["g"])
+            self.assertEqual(await fetch_groups(db, due=now - timedelta(seconds=10)), [])
+
+            await add_group_room(db, "g", "a")
+            await add_group_room(db, "g", "b")
+            await add_group_room(db, "g", "b")
+            rooms = await fetch_group_rooms(db, "g")
+            self.assertEqual([r.room_id for r in rooms], ["a", "b"])
+            self.assertEqual([r.tz for r in rooms], [ZONE, None])
+            self.assertEqual([g.name for g in await fetch_groups(db, "a")], ["g"])
+
+            for r in rooms:
+                await insert_outreach(db, Outreach(r.room_id, f"o-{r.room_id}", "g", now, "Check in"))
+            outreach = await fetch_outreach(db, "b", "o-b")
+            self.assertEqual(outreach.prompt_name, "g")
+            self.assertEqual(outreach.timestamp, now)
+
+            await remove_group_room(db, "g", "a")
+            self.assertEqual([r.room_id for r in await fetch_group_rooms(db, "g")], ["b"])
+            self.assertEqual(await fetch_groups(db, "a"), [])
+
+            await delete_group(db, "g")
+            self.assertEqual(None, await fetch_group(db, "g"))
+            self.assertEqual(await fetch_group_rooms(db, "g"), [])
+            self.assertEqual([g.name for g in await fetch_groups(db)], ["h"])
+        finally:
+            await db.stop()
+            for path in DB_FILES:
+                if path.exists():
+                    path.unlink()
+
+    async def test_prompt_stats(self) -> None:
+        db = Database.create(DB_URI, upgrade_table=upgrade_table)
+        await db.start()
+        try:
+            await upsert_room(db, Room("a"))
+            await upsert_room(db, Room("b"))
+            start = datetime(2024, 5, 1, 17, 0, tzinfo=timezone.utc)
+
+            stats = await fetch_prompt_stats(db, "a", "foo")
+            self.assertEqual(stats.current_streak, 0)
+            self.assertEqual(stats.last_response, None)
+
+            await insert_outreach(db, Outreach("a", "o1", "foo", start, "?"))
+            self.assertEqual((await fetch_prompt_stats(db, "a", "foo")).current_streak, 0)
+            await insert_response(db, Response("a", "r1", "o1", start + timedelta(minutes=1), "one"))
+            await insert_response(db, Response("a", "r2", "o1", start + timedelta(minutes=2), "two"))
+            stats = await fetch_prompt_stats(db, "a", "foo")
+            self.assertEqual(stats.current_streak, 1)
+            self.assertEqual(stats.last_response, "two")
+            self.assertEqual(stats.last_response_time, start + timedelta(minutes=2))
+
+            await insert_outreach(db, Outreach("a", "o2", "foo", start + timedelta(days=1), "?"))
+            self.assertEqual((await fetch_prompt_stats(db, "a", "foo")).current_streak, 0)
+            await insert_response(db, Response("a", "r3", "o2", start + timedelta(days=1, minutes=1), "three"))
+            self.assertEqual((await fetch_prompt_stats(db, "a", "foo")).current_streak, 2)
+
+            # A late response to an older outreach does not extend the streak, but it becomes the last response since it is the newest by time
+            await insert_outreach(db, Outreach("a", "o3", "foo", start + timedelta(days=2), "?"))
+            await insert_response(db, Response("a", "r4", "o1", start + timedelta(days=2, minutes=1), "late"))
+            stats = await fetch_prompt_stats(db, "a", "foo")
+            self.assertEqual(stats.current_streak, 0)
+            self.assertEqual(stats.last_response, "late")
+
+            # Missing an outreach resets the streak
+            await insert_outreach(db, Outreach("a", "o4", "foo", start + timedelta(days=3), "?"))
+            await insert_response(db, Response("a", "r5", "o4", start + timedelta(days=3, minutes=1), "back"))
+            self.assertEqual((await fetch_prompt_stats(db, "a", "foo")).current_streak, 1)
+
+            await upsert_group(db, Group("g", "?"))
+            await add_group_room(db, "g", "a")
+            await add_group_room(db, "g", "b")
+            await insert_outreach(db, Outreach("a", "g1", "g", start, "?"))
+            await insert_outreach(db, Outreach("b", "g2", "g", start, "?"))
+            await insert_response(db, Response("b", "r6", "g2", start + timedelta(minutes=1), "yes"))
+            # Room c isn't in the group, so its prompt with the same name is ignored
+            await upsert_room(db, Room("c"))
+            await insert_outreach(db, Outreach("c", "c1", "g", start, "?"))
+            stats_by_room = await fetch_group_prompt_stats(db, "g")
+            self.assertEqual(set(stats_by_room), {"a", "b"})
+            self.assertEqual(stats_by_room["a"].current_streak, 0)
+            self.assertEqual(stats_by_room["b"].current_streak, 1)
+            self.assertEqual(stats_by_room["b"].last_response, "yes")
+        finally:
+            await db.stop()
+            for path in DB_FILES:
+                if path.exists():
+                    path.unlink()
+
+    async def test_prompt_stats_upgrade(self) -> None:
+        # Build a database at v3, before prompt_stats existed
+        v3_upgrade_table = UpgradeTable()
+        v3_upgrade_table.upgrades = upgrade_table.upgrades[:3]
+        db = Database.create(DB_URI, upgrade_table=v3_upgrade_table)
+        await db.start()
+        try:
+            await upsert_room(db, Room("a"))
+            start = datetime(2024, 5, 1, 17, 0, tzinfo=timezone.utc)
+            outreaches = [("o1", "foo", 0), ("o2", "foo", 1), ("o3", "foo", 2), ("o4", "foo", 3), ("o5", "foo", 4), ("b1", "bar", 0), ("q1", "baz", 0), ("q2", "baz", 1)]
+            for event_id, prompt_name, day in outreaches:
+                ts = (start + timedelta(days=day)).strftime("%Y-%m-%d %H:%M:%S")
+                await db.execute("INSERT INTO outreaches(room_id, event_id, prompt_name, timestamp_utc, message) VALUES ('a', $1, $2, $3, '?')", event_id, prompt_name, ts)
+            # o2 is only answered after o5 went out, so it still breaks the streak; o3 and o4 are answered, o5 is still open.
+            # q1 is only answered after q2 went out, so only q2 counts.
+            responses = [("r1", "o1", 0, 1, "first"), ("r3", "o3", 2, 1, "third"), ("r4", "o4", 3, 1, "fourth"), ("r5", "o2", 5, 1, "late"), ("s2", "q2", 1, 1, "q2"), ("s1", "q1", 1, 2, "q1 late")]
+            for event_id, outreach_event_id, day, minutes, message in responses:
+                ts = (start + timedelta(days=day, minutes=minutes)).strftime("%Y-%m-%d %H:%M:%S")
+                await db.execute("INSERT INTO responses(room_id, event_id, outreach_event_id, timestamp_utc, message) VALUES ('a', $1, $2, $3, $4)", event_id, outreach_event_id, ts, message)
+        finally:
+            await db.stop()
+
+        db = Database.create(DB_URI, upgrade_table=upgrade_table)
+        await db.start()
+        try:
+            stats = await fetch_prompt_stats(db, "a", "foo")
+            self.assertEqual(stats.streak, 2)
+            self.assertEqual(stats.current_streak, 0)
+            self.assertEqual(stats.last_outreach_event_id, "o5")
+            self.assertEqual(stats.last_response, "late")
+            self.assertEqual(stats.last_response_time, start + timedelta(days=5, minutes=1))
+
+            await insert_response(db, Response("a", "r6", "o5", start + timedelta(days=6), "fifth"))
+            self.assertEqual((await fetch_prompt_stats(db, "a", "foo")).current_streak, 3)
+
+            stats = await fetch_prompt_stats(db, "a", "baz")
+            self.assertEqual(stats.current_streak, 1)
+            self.assertEqual(stats.last_response, "q1 late")
+
+            stats = await fetch_prompt_stats(db, "a", "bar")
+            self.assertEqual(stats.current_streak, 0)
+            self.assertEqual(stats.last_outreach_event_id, "b1")
+            self.assertEqual(stats.last_response, None)
+        finally:
+            await db.stop()
+            for path in DB_FILES:
+                if path.exists():
+                    path.unlink()
+
 
 if __name__ == "__main__":
     unittest.main()
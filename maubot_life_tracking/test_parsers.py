@@ -1,6 +1,7 @@
 import unittest
-from maubot_life_tracking.parsers import parse_datetime, parse_interval, render_template
-from datetime import datetime, timedelta
+from maubot_life_tracking.parsers import parse_datetime, parse_interval, render_template, render_history, chunk_lines, compile_template
+from maubot_life_tracking import db
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 
 
@@ -47,6 +48,41 @@ class TestParsers(unittest.TestCase):
         now = datetime(2024, 5, 17)
         self.assertEqual("it is Friday, May 17, 2024 - hi!", render_template("it is $(date) - hi!", now))
 
+    def test_compile_template(self) -> None:
+        now = datetime(2024, 5, 17, 12, 0, tzinfo=ZONE)
+        template = compile_template("$(date): $(streak) in a row, last said $(last_response) $(days_since_last) days ago $(unknown)")
+        self.assertTrue(template.uses_stats)
+        self.assertFalse(compile_template("it is $(date)").uses_stats)
+
+        stats = db.PromptStats("a", "foo", 3, "good", datetime(2024, 5, 15, 13, 0, tzinfo=timezone.utc), "o1", True)
+        self.assertEqual("Friday, May 17, 2024: 3 in a row, last said good 2 days ago $(unknown)", template.render(now, stats))
+        stats.last_outreach_answered = False
+        self.assertEqual("Friday, May 17, 2024: 0 in a row, last said good 2 days ago $(unknown)", template.render(now, stats))
+        self.assertEqual("Friday, May 17, 2024: 0 in a row, last said  never days ago $(unknown)", template.render(now))
+
+    def test_days_since_last_uses_local_calendar_days(self) -> None:
+        template = compile_template("$(days_since_last)")
+        # Answered yesterday at 17:05 local time; today's 17:00 send is less than 24 hours later
+        stats = db.PromptStats("a", "foo", last_response_time=datetime(2024, 5, 17, 0, 5, tzinfo=timezone.utc))
+        self.assertEqual("1", template.render(datetime(2024, 5, 17, 17, 0, tzinfo=ZONE), stats))
+        self.assertEqual("0", template.render(datetime(2024, 5, 16, 23, 0, tzinfo=ZONE), stats))
+
+    def test_render_history(self) -> None:
+        outreach1 = db.Outreach("a", "o1", "foo", datetime(2024, 5, 17, 0, 30, tzinfo=timezone.utc), "How are you?")
+        outreach2 = db.Outreach("a", "o2", "foo", datetime(2024, 5, 16, 0, 30, tzinfo=timezone.utc), "How are you?")
+        response = db.Response("a", "r1", "o1", datetime(2024, 5, 17, 1, 0, tzinfo=timezone.utc), "good")
+        self.assertEqual([
+            "- 2024-05-16 17:30: How are you?",
+            "  - 2024-05-16 18:00: good",
+            "- 2024-05-15 17:30: How are you?",
+            "  - (no response)",
+        ], render_history([(outreach1, [response]), (outreach2, [])], ZONE))
+
+    def test_chunk_lines(self) -> None:
+        self.assertEqual([], chunk_lines([]))
+        self.assertEqual(["aa\nbb", "cc"], chunk_lines(["aa", "bb", "cc"], 6))
+        self.assertEqual(["aaaa…", "b"], chunk_lines(["aaaaaaaa", "b"], 5))
+
 
 if __name__ == "__main__":
     unittest.main()